@@ -39,6 +39,11 @@ MESSAGES = {
         "4. Receive your secret code\n"
         "5. Use /refund to get a refund if needed"
     ),
+    'purchase_unknown': (
+        "❌ Sorry, this item is no longer available.\n\n"
+        "To get a refund, use this command:\n"
+        "`/refund %s`"
+    ),
     'refund_success': (
         "✅ Refund processed successfully!\n"
         "The Stars have been returned to your balance."
@@ -47,6 +52,19 @@ MESSAGES = {
         "❌ Refund could not be processed.\n"
         "Please try again later or contact support."
     ),
+    'purchase_success': (
+        "Thank you for your purchase! 🎉\n\n"
+        "Here's your secret code for %(name)s:\n"
+        "`%(secret)s`\n\n"
+        "To get a refund, use this command:\n"
+        "`/refund %%s`\n\n"
+        "Save this message to request a refund later if needed."
+    ),
+    'refund_error': (
+        "❌ Sorry, there was an error processing your refund:\n"
+        "Error: %s - %s\n\n"
+        "Please make sure you provided the correct transaction ID and try again."
+    ),
     'refund_usage': (
         "Please provide the transaction ID after the /refund command.\n"
         "Example: `/refund YOUR_TRANSACTION_ID`"
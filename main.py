@@ -4,12 +4,16 @@ This bot allows users to purchase digital items using Telegram Stars and request
 """
 
 import os
+import json
+import time
 import logging
-import traceback
-from collections import defaultdict
-from typing import DefaultDict, Dict
+from collections import Counter
+from typing import Any, Dict, List, Optional, TextIO
 from dotenv import load_dotenv
-from telegram import Update, LabeledPrice, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram import Update, LabeledPrice, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -25,6 +29,14 @@ from config import ITEMS, MESSAGES
 # Load environment variables
 load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+PORT = int(os.getenv('PORT', 8443))
+STATS_LOG = os.getenv('STATS_LOG', 'stats.jsonl')
+STATS_FLUSH_INTERVAL = 30
+
+# The only update types the bot handles
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.PRE_CHECKOUT_QUERY]
 
 # Setup logging
 logging.basicConfig(
@@ -33,35 +45,133 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Store statistics
-STATS: Dict[str, DefaultDict[str, int]] = {
-    'purchases': defaultdict(int),
-    'refunds': defaultdict(int)
+# Store statistics, keyed by user ID
+STATS: Dict[str, Counter] = {
+    'purchases': Counter(),
+    'refunds': Counter()
+}
+
+# Event type codes used in the statistics journal
+STATS_EVENTS = {'p': 'purchases', 'r': 'refunds'}
+
+
+def load_stats(path: str) -> None:
+    """Rebuild STATS by replaying the append-only statistics journal."""
+    user_ids: Dict[str, List[int]] = {kind: [] for kind in STATS}
+    try:
+        with open(path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    event = json.loads(line)
+                    user_ids[STATS_EVENTS[event['t']]].append(event['u'])
+                except (ValueError, KeyError, TypeError):
+                    # Skip malformed lines, such as one cut short by a crash
+                    continue
+    except FileNotFoundError:
+        return
+
+    for kind, ids in user_ids.items():
+        STATS[kind].update(ids)
+
+
+def open_stats_log(path: str) -> TextIO:
+    """Open the statistics journal for appending."""
+    # Events are only appended, so a large write buffer turns them into occasional sequential writes
+    journal = open(path, 'a', buffering=1 << 16, encoding='utf-8')
+
+    # Terminate a line cut short by a crash so the next event is not glued onto it
+    if os.path.getsize(path):
+        with open(path, 'rb') as tail:
+            tail.seek(-1, os.SEEK_END)
+            if tail.read(1) != b'\n':
+                journal.write('\n')
+
+    return journal
+
+
+_EVENT_LOG: Optional[TextIO] = None
+
+
+def record_event(event_type: str, user_id: int, **fields: Any) -> None:
+    """Count a purchase or refund and append it to the statistics journal."""
+    STATS[STATS_EVENTS[event_type]][user_id] += 1
+    try:
+        _EVENT_LOG.write(json.dumps({
+            't': event_type,
+            'u': user_id,
+            'ts': int(time.time()),
+            **fields
+        }) + '\n')
+    except (OSError, ValueError):
+        # A failed write must not turn a completed payment or refund into an error reply
+        logger.exception("Could not journal %s event for user %s", event_type, user_id)
+
+
+async def flush_stats(context: CallbackContext) -> None:
+    """Write buffered statistics events to disk."""
+    _EVENT_LOG.flush()
+
+
+async def open_stats(application: Application) -> None:
+    """Replay the statistics journal and open it for new events on startup."""
+    global _EVENT_LOG
+    load_stats(STATS_LOG)
+    _EVENT_LOG = open_stats_log(STATS_LOG)
+
+
+async def close_stats(application: Application) -> None:
+    """Flush and close the statistics journal on shutdown."""
+    if _EVENT_LOG is not None:
+        _EVENT_LOG.close()
+
+
+# ITEMS is static, so the item selection keyboard is built once at import
+WELCOME_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"{item['name']} - {item['price']} ⭐", callback_data=item_id)]
+    for item_id, item in ITEMS.items()
+])
+
+# Invoice parameters per item, ready to be passed to send_invoice
+INVOICE_KWARGS: Dict[str, Dict[str, Any]] = {
+    item_id: {
+        'title': item['name'],
+        'description': item['description'],
+        'payload': item_id,
+        'provider_token': "",  # Empty for digital goods
+        'currency': "XTR",  # Telegram Stars currency code
+        'prices': [LabeledPrice(item['name'], int(item['price']))],
+        'start_parameter': "start_parameter"
+    }
+    for item_id, item in ITEMS.items()
+}
+
+# Purchase reply per item with name and secret filled in, leaving only the charge ID
+SUCCESS_MSG: Dict[str, str] = {
+    item_id: MESSAGES['purchase_success'] % {
+        'name': item['name'].replace('%', '%%'),
+        'secret': item['secret'].replace('%', '%%')
+    }
+    for item_id, item in ITEMS.items()
+}
+
+# Reply arguments for /help, which never change
+HELP_KW: Dict[str, Any] = {
+    'text': MESSAGES['help'],
+    'parse_mode': ParseMode.MARKDOWN
 }
 
 
 async def start(update: Update, context: CallbackContext) -> None:
     """Handle /start command - show available items."""
-    keyboard = []
-    for item_id, item in ITEMS.items():
-        keyboard.append([InlineKeyboardButton(
-            f"{item['name']} - {item['price']} ⭐",
-            callback_data=item_id
-        )])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         MESSAGES['welcome'],
-        reply_markup=reply_markup
+        reply_markup=WELCOME_KEYBOARD
     )
 
 
 async def help_command(update: Update, context: CallbackContext) -> None:
     """Handle /help command - show help information."""
-    await update.message.reply_text(
-        MESSAGES['help'],
-        parse_mode='Markdown'
-    )
+    await update.message.reply_text(**HELP_KW)
 
 
 async def refund_command(update: Update, context: CallbackContext) -> None:
@@ -72,68 +182,61 @@ async def refund_command(update: Update, context: CallbackContext) -> None:
         )
         return
 
-    try:
-        charge_id = context.args[0]
-        user_id = update.effective_user.id
+    charge_id = context.args[0]
+    user_id = update.effective_user.id
 
+    try:
         # Call the refund API
         success = await context.bot.refund_star_payment(
             user_id=user_id,
             telegram_payment_charge_id=charge_id
         )
 
-        if success:
-            STATS['refunds'][str(user_id)] += 1
-            await update.message.reply_text(MESSAGES['refund_success'])
-        else:
-            await update.message.reply_text(MESSAGES['refund_failed'])
-
     except Exception as e:
-        error_text = f"Error type: {type(e).__name__}\n"
-        error_text += f"Error message: {str(e)}\n"
-        error_text += f"Traceback:\n{''.join(traceback.format_tb(e.__traceback__))}"
-        logger.error(error_text)
+        logger.exception("Refund failed for user %s charge %s", user_id, charge_id)
 
         await update.message.reply_text(
-            f"❌ Sorry, there was an error processing your refund:\n"
-            f"Error: {type(e).__name__} - {str(e)}\n\n"
-            "Please make sure you provided the correct transaction ID and try again."
+            MESSAGES['refund_error'] % (type(e).__name__, e)
         )
+        return
+
+    if success:
+        record_event('r', user_id, c=charge_id)
+        await update.message.reply_text(MESSAGES['refund_success'])
+    else:
+        await update.message.reply_text(MESSAGES['refund_failed'])
 
 
 async def button_handler(update: Update, context: CallbackContext) -> None:
     """Handle button clicks for item selection."""
     query = update.callback_query
-    if not query or not query.message:
+    if query is None:
         return
 
-    try:
-        await query.answer()
+    # Only full messages carry chat_id; inaccessible ones cannot be replied to
+    message = query.message
+    chat_id = getattr(message, 'chat_id', None)
+    if chat_id is None:
+        return
 
-        item_id = query.data
-        item = ITEMS[item_id]
+    invoice_kwargs = INVOICE_KWARGS.get(query.data)
+    if invoice_kwargs is None:
+        await query.answer("This item is no longer available.")
+        return
 
-        # Make sure message exists before trying to use it
-        if not isinstance(query.message, Message):
-            return
+    try:
+        await query.answer()
 
         await context.bot.send_invoice(
-            chat_id=query.message.chat_id,
-            title=item['name'],
-            description=item['description'],
-            payload=item_id,
-            provider_token="",  # Empty for digital goods
-            currency="XTR",  # Telegram Stars currency code
-            prices=[LabeledPrice(item['name'], int(item['price']))],
-            start_parameter="start_parameter"
+            chat_id=chat_id,
+            **invoice_kwargs
         )
 
-    except Exception as e:
+    except TelegramError as e:
         logger.error(f"Error in button_handler: {str(e)}")
-        if query and query.message and isinstance(query.message, Message):
-            await query.message.reply_text(
-                "Sorry, something went wrong while processing your request."
-            )
+        await message.reply_text(
+            "Sorry, something went wrong while processing your request."
+        )
 
 
 async def precheckout_callback(update: Update, context: CallbackContext) -> None:
@@ -149,25 +252,31 @@ async def successful_payment_callback(update: Update, context: CallbackContext)
     """Handle successful payments."""
     payment = update.message.successful_payment
     item_id = payment.invoice_payload
-    item = ITEMS[item_id]
+    success_msg = SUCCESS_MSG.get(item_id)
     user_id = update.effective_user.id
 
-    # Update statistics
-    STATS['purchases'][str(user_id)] += 1
+    # Update statistics; the user has been charged even if the item is gone
+    record_event('p', user_id, i=item_id)
+
+    if success_msg is None:
+        logger.warning(
+            "Payment from user %s for unknown item %s (charge_id: %s)",
+            user_id, item_id, payment.telegram_payment_charge_id
+        )
+        await update.message.reply_text(
+            MESSAGES['purchase_unknown'] % payment.telegram_payment_charge_id,
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
 
     logger.info(
-        f"Successful payment from user {user_id} "
-        f"for item {item_id} (charge_id: {payment.telegram_payment_charge_id})"
+        "Successful payment from user %s for item %s (charge_id: %s)",
+        user_id, item_id, payment.telegram_payment_charge_id
     )
 
     await update.message.reply_text(
-        f"Thank you for your purchase! 🎉\n\n"
-        f"Here's your secret code for {item['name']}:\n"
-        f"`{item['secret']}`\n\n"
-        f"To get a refund, use this command:\n"
-        f"`/refund {payment.telegram_payment_charge_id}`\n\n"
-        "Save this message to request a refund later if needed.",
-        parse_mode='Markdown'
+        success_msg % payment.telegram_payment_charge_id,
+        parse_mode=ParseMode.MARKDOWN
     )
 
 
@@ -179,22 +288,58 @@ async def error_handler(update: Update, context: CallbackContext) -> None:
 def main() -> None:
     """Start the bot."""
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
+        # A larger HTTP/2 pool lets concurrent handlers share connections to the Bot API
+        request = HTTPXRequest(
+            connection_pool_size=256,
+            http_version="2",
+            read_timeout=15,
+            write_timeout=15
+        )
+        # getUpdates calls are sequential, so a single connection is enough
+        get_updates_request = HTTPXRequest(http_version="2")
+
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .request(request)
+            .get_updates_request(get_updates_request)
+            .post_init(open_stats)
+            .post_shutdown(close_stats)
+            .build()
+        )
 
-        # Add handlers
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("refund", refund_command))
-        application.add_handler(CallbackQueryHandler(button_handler))
-        application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-        application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
+        # Add handlers; none of them depend on each other, so none block the dispatcher
+        application.add_handler(CommandHandler("start", start, block=False))
+        application.add_handler(CommandHandler("help", help_command, block=False))
+        application.add_handler(CommandHandler("refund", refund_command, block=False))
+        application.add_handler(CallbackQueryHandler(button_handler, block=False))
+        application.add_handler(PreCheckoutQueryHandler(precheckout_callback, block=False))
+        application.add_handler(MessageHandler(
+            filters.SUCCESSFUL_PAYMENT, successful_payment_callback, block=False
+        ))
 
         # Add error handler
         application.add_error_handler(error_handler)
 
+        # Periodically persist statistics events
+        application.job_queue.run_repeating(flush_stats, interval=STATS_FLUSH_INTERVAL)
+
         # Start the bot
         logger.info("Bot started")
-        application.run_polling()
+        if WEBHOOK_URL:
+            application.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=BOT_TOKEN,
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES
+            )
+        else:
+            application.run_polling(
+                timeout=50,
+                allowed_updates=ALLOWED_UPDATES
+            )
 
     except Exception as e:
         logger.error(f"Error starting bot: {str(e)}")